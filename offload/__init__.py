@@ -112,6 +112,15 @@ EXCLUDE_FILES = ["MEDIAPRO.XML",
                  "store_generation.",
                  "store_generation.\r",
                  ".Spotlight-V100"]
+# Folders that are skipped with everything inside them
+EXCLUDE_FOLDERS = [".Spotlight-V100",
+                   ".fseventsd",
+                   ".Trashes",
+                   ".TemporaryItems",
+                   ".DocumentRevisions-V100",
+                   "System Volume Information",
+                   "$RECYCLE.BIN"]
+IGNORE_FILE = ".offloadignore"
 
 _script_data = Path(os.getcwd()) / 'data'
 _script_data.mkdir(parents=True, exist_ok=True)
@@ -11,11 +11,14 @@ import logging
 import argparse
 import time
 import csv
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from PyQt5.QtCore import QThread, pyqtSignal
 
-from offload import APP_DATA_PATH, REPORTS_PATH, EXCLUDE_FILES, utils
+from offload import APP_DATA_PATH, REPORTS_PATH, EXCLUDE_FILES, EXCLUDE_FOLDERS, IGNORE_FILE, utils
 from offload.utils import FileList, File, Settings
 
 
@@ -28,7 +31,18 @@ class Offloader(QThread):
                  filename=None,
                  prefix=None,
                  dryrun=False,
-                 log_level='info'):
+                 log_level='info',
+                 workers=1,
+                 backend='auto',
+                 verify='cache',
+                 prefetch=2,
+                 sync='end',
+                 read_order='mtime',
+                 stream=False,
+                 scan_workers=1,
+                 exclude=None,
+                 compact=False,
+                 scan_filter=None):
         super(Offloader, self).__init__()
         self.settings = Settings()
         self._logger = utils.setup_logger(log_level)
@@ -53,18 +67,53 @@ class Offloader(QThread):
 
         self._mode = mode
         self._dryrun = dryrun
-        self._exclude = EXCLUDE_FILES
+        self._exclude_extra = list(exclude or ())
+        self._exclude = self._exclude_rules()
         self._signal = {'percentage': 0, 'action': '', 'time': '', 'is_finished': False}
         self._running = True
+        self._workers = max(1, int(workers))
+        self._backend = backend
+        self._verify = verify
+        if self._verify == 'disk' and not utils.cache_bypass_supported():
+            logging.warning("The page cache can't be bypassed on this platform, copies are verified from memory")
+            self._verify = 'cache'
+        self._prefetch = prefetch
+        self._sync_policy = utils.SyncPolicy(sync)
+        self._read_order = read_order
+        self._stream = stream
+        self._stream_queue_size = 64
+        self._max_collisions = 10
+        self._scan_workers = max(1, int(scan_workers))
+        self._compact = compact
+        self._scan_filter = scan_filter
+        self._no_clone_devices = set()
+        self._prefetcher = None
+        self._lock = threading.Lock()
+        self._pending_paths = {}
+        self._destination_index = utils.FolderIndex()
+        self._delete_journal = utils.DeleteJournal()
+        self._verified_sources = []
+
+        # Finish deleting the sources of an interrupted move before listing the files
+        if self._mode == 'move' and not self._dryrun:
+            self._delete_sources()
 
         # Properties
-        logging.info("Getting list of files")
-        self.source_files = FileList(self._source, exclude=self._exclude)
-        self.source_files.sort()
+        if self._stream:
+            # The files are listed while they are transferred
+            self.source_files = FileList(self._source, exclude=self._exclude, scan=False,
+                                         scan_workers=self._scan_workers, compact=self._compact,
+                                         scan_filter=self._scan_filter)
+        else:
+            logging.info("Getting list of files")
+            self.source_files = FileList(self._source, exclude=self._exclude, scan_workers=self._scan_workers,
+                                         compact=self._compact, scan_filter=self._scan_filter)
+            self.source_files.sort()
 
         # Offload attributes
         self.ol_time_started = 0
         self.ol_bytes_transferred = 0
+        self.ol_bytes_total = self.source_files.size
 
         # Set some variables
         self.destination_folders = []
@@ -96,7 +145,12 @@ class Offloader(QThread):
         """Set the source directory"""
         if Path(path).is_dir():
             self._source = Path(path)
-            self.source_files = FileList(self._source, exclude=self._exclude)
+            self._exclude = self._exclude_rules()
+            # When streaming, the files are listed while they are transferred
+            self.source_files = FileList(self._source, exclude=self._exclude, scan=not self._stream,
+                                         scan_workers=self._scan_workers, compact=self._compact,
+                                         scan_filter=self._scan_filter)
+            self.ol_bytes_total = self.source_files.size
         else:
             logging.error(f'{path} is not a valid directory')
 
@@ -122,7 +176,9 @@ class Offloader(QThread):
 
     @property
     def ol_percentage(self):
-        return round((self.ol_bytes_transferred / self.source_files.size) * 100, 2)
+        if not self.ol_bytes_total:
+            return 0
+        return round((self.ol_bytes_transferred / self.ol_bytes_total) * 100, 2)
 
     @property
     def ol_time_elapsed(self):
@@ -130,7 +186,7 @@ class Offloader(QThread):
 
     @property
     def ol_bytes_remaining(self):
-        return self.source_files.size - self.ol_bytes_transferred
+        return self.ol_bytes_total - self.ol_bytes_transferred
 
     @property
     def ol_time_remaining(self):
@@ -138,67 +194,258 @@ class Offloader(QThread):
 
     @property
     def ol_speed(self):
-        return self.ol_bytes_transferred / self.ol_time_elapsed
+        elapsed = self.ol_time_elapsed
+        return self.ol_bytes_transferred / elapsed if elapsed else 0
 
     def offload(self):
         """Offload files"""
         # Offload start time
         self.ol_time_started = time.time()
+        self.ol_bytes_transferred = 0
+        self._destination_index = utils.FolderIndex()
+
+        if self._stream:
+            # Start transferring before the scan is finished, the totals grow while the scan runs
+            logging.info("Transferring files while the source is scanned")
+            self.source_files = FileList(self._source, exclude=self._exclude, scan=False,
+                                         scan_workers=self._scan_workers, compact=self._compact,
+                                         scan_filter=self._scan_filter)
+            order = range(0)
+        else:
+            # Get list of files in source folder
+            logging.info(f"Total file size: {self.source_files.hsize}")
+            logging.info(f"Average file size: {utils.convert_size(self.source_files.avg_file_size)}")
+            logging.info("---\n")
 
-        # Get list of files in source folder
-        logging.info(f"Total file size: {self.source_files.hsize}")
-        logging.info(f"Average file size: {utils.convert_size(self.source_files.avg_file_size)}")
-        logging.info("---\n")
+            # Read the files in the order they are stored on disk, the report keeps the logical order
+            if self._read_order == 'physical':
+                logging.info("Reading files in the order they are stored on disk")
+                order = self.source_files.read_order()
+            else:
+                order = range(self.source_files.count)
+        files = self.source_files.files
+        self.ol_bytes_total = self.source_files.size
+
+        # Warm up the next files while the current one is transferred
+        if self._prefetch and not self._dryrun:
+            # Paths are looked up when they are needed instead of listing them all up front. Streamed files are
+            # transferred in the order they are found
+            source_files = self.source_files
+            if self._stream:
+                path = source_files.path
+            else:
+                def path(position):
+                    return source_files.path(order[position])
+            self._prefetcher = utils.Prefetcher(path, count=len(order), depth=self._prefetch * self._workers)
 
         # Iterate over all the files
-        for file_id, source_file in enumerate(self.source_files.files):
-            skip = False
+        try:
+            if self._stream:
+                self._offload_streaming()
+            elif self._workers > 1:
+                self._offload_queued((file_id, files[file_id], position) for position, file_id in enumerate(order))
+            else:
+                for position, file_id in enumerate(order):
+                    self._offload_file(file_id, files[file_id], position)
+        finally:
+            if self._prefetcher is not None:
+                self._prefetcher.close()
+                self._prefetcher = None
+
+        if self._stream:
+            logging.info(f"Total file size: {self.source_files.hsize}")
+            logging.info(f"Average file size: {utils.convert_size(self.source_files.avg_file_size)}")
+
+        # Flush the transferred files to disk
+        if not self._dryrun and self._destination.is_dir():
+            self._sync_policy.finish(self._destination)
+            if self._verified_sources and self._sync_policy.mode == 'none':
+                # Sources are only deleted once their copies are on disk
+                utils.syncfs(self._destination)
+
+        # Delete the verified source files now that the reads are done
+        if self._mode == 'move' and not self._dryrun:
+            for source_path, source_stat, dest_path in self._verified_sources:
+                self._delete_journal.add(source_path, source_stat, dest_path)
+            self._verified_sources.clear()
+            self._delete_sources()
 
-            # Display how far along the transfer we are
-            logging.info(f"Processing file {file_id + 1}/{len(self.source_files.files)} "
-                         f"(~{self.ol_percentage}%) | {source_file.filename}")
+        # Print created destination folders
+        if self.destination_folders:
+            # Sort folder for better output
+            self.destination_folders.sort()
 
-            # Send signal to GUI
-            self._signal['percentage'] = int(self.ol_percentage)
-            self._signal['action'] = f'Processing file {file_id + 1}/{len(self.source_files.files)}'
-            self._signal['time'] = self.ol_time_remaining
-            self._progress_signal.emit(self._signal)
+            logging.info(f"Created the following folders {', '.join([str(x.name) for x in self.destination_folders])}")
+            logging.debug([str(x.resolve()) for x in self.destination_folders])
 
-            # Create File object for destination file
-            dest_folder = self._destination / utils.destination_folder(source_file.mdate, preset=self._structure)
-            dest_file = File(dest_folder / source_file.filename, prefix=self._prefix)
+        logging.info(f"{len(self.processed_files)} files processed")
+        logging.debug(f"Processed files: {self.processed_files}")
+
+        logging.info(f"{len(self.destination_folders)} destination folders")
+        logging.debug(f"Destination folders: {self.destination_folders}")
+
+        logging.info(f"{len(self.skipped_files)} files skipped")
+        logging.debug(f"Skipped files: {self.skipped_files}")
 
-            # Change filename
-            if self._filename:
-                logging.debug(f'New user given filename is {self._filename}')
-                new_name = source_file.exifdata.get(utils.Preset.filename(self._filename), "unknown").lower()
-                logging.debug(new_name)
-                dest_file.name = new_name
+        logging.info(f"Sync policy: {self._sync_policy} ({self._sync_policy.syncs} syncs)")
 
-            # Add prefix to filename
-            dest_file.set_prefix(self._prefix, custom_date=source_file.mdate)
+        # Save report to desktop
+        print(self._running)
+        self.report.close()
+        self.report.save()
+        self.report.write_html()
+        self._signal['time'] = 0
+        self._signal['is_finished'] = True
+        self._progress_signal.emit(self._signal)
+        return True
 
-            # Add destination folder to list of destination folders
+    def _exclude_rules(self):
+        """Compile the rules for files and folders to leave out of the offload
+
+        Combines the built-in rules, the rules given to the offloader and the rules in an .offloadignore file
+        in the root of the source.
+        """
+        rules = utils.ExcludeRules(names=EXCLUDE_FILES + [IGNORE_FILE], rules=self._exclude_extra,
+                                   folders=EXCLUDE_FOLDERS)
+        if rules.load(self._source / IGNORE_FILE):
+            logging.info(f"Using exclusion rules from {self._source / IGNORE_FILE}")
+        return rules
+
+    def _offload_streaming(self):
+        """Scan the source and transfer each file as soon as it is found
+
+        Files are transferred in the order they are found instead of by modification date.
+        """
+        def scan():
+            for file_id, source_file in enumerate(self.source_files.scan()):
+                with self._lock:
+                    self.ol_bytes_total = self.source_files.size
+                if self._prefetcher is not None:
+                    self._prefetcher.add()
+                yield file_id, source_file
+
+        self._offload_queued(scan())
+
+    def _offload_queued(self, items):
+        """Transfer files with the workers as they are produced
+
+        The items are put in a bounded queue by a separate thread, so it never runs far ahead of the transfers
+        and File objects are only created for the files that are about to be transferred.
+
+        Args:
+            items: iterable of the arguments for _offload_file
+        """
+        files = queue.Queue(maxsize=self._stream_queue_size * self._workers)
+        done = object()
+        stop = threading.Event()
+
+        def put(item):
+            # Give up if the transfers have stopped, so the producer doesn't wait for a free slot forever
+            while not stop.is_set():
+                try:
+                    files.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for item in items:
+                    if not put(item):
+                        return
+            finally:
+                for _ in range(self._workers):
+                    put(done)
+
+        def transfer():
+            try:
+                while not stop.is_set():
+                    try:
+                        item = files.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    if item is done:
+                        return
+                    self._offload_file(*item)
+            except BaseException:
+                stop.set()
+                raise
+
+        if self._workers > 1:
+            logging.info(f"Transferring files using {self._workers} workers")
+        with ThreadPoolExecutor(max_workers=self._workers + 1) as executor:
+            futures = [executor.submit(produce)] + [executor.submit(transfer) for _ in range(self._workers)]
+            # Raise any exceptions from the producer and the workers
+            for future in futures:
+                future.result()
+
+    def _offload_file(self, file_id, source_file, position=None):
+        """Copy, verify and report a single file. Safe to call from several worker threads
+
+        Args:
+            file_id: index of the file in the source file list, used to order the report
+            source_file: the file to offload
+            position: index of the file in the read order, defaults to file_id
+        """
+        if position is None:
+            position = file_id
+        skip = False
+        progress = f'Processing file {position + 1}/{len(self.source_files.files)}'
+
+        # Display how far along the transfer we are
+        logging.info(f"{progress} (~{self.ol_percentage}%) | {source_file.filename}")
+
+        # Send signal to GUI
+        self._emit_progress(progress)
+
+        if self._prefetcher is not None:
+            self._prefetcher.advance(position)
+
+        # Create File object for destination file
+        dest_folder = self._destination / utils.destination_folder(source_file.mdate, preset=self._structure)
+        dest_file = File(dest_folder / source_file.filename, prefix=self._prefix)
+
+        # Change filename
+        if self._filename:
+            logging.debug(f'New user given filename is {self._filename}')
+            new_name = source_file.exifdata.get(utils.Preset.filename(self._filename), "unknown").lower()
+            logging.debug(new_name)
+            dest_file.name = new_name
+
+        # Add prefix to filename
+        dest_file.set_prefix(self._prefix, custom_date=source_file.mdate)
+
+        # Add destination folder to list of destination folders
+        with self._lock:
             if dest_folder not in self.destination_folders:
                 self.destination_folders.append(dest_folder)
 
-            # Write to report
-            if not self._running:
-                self.report.write(source_file, dest_file, 'Not started', checksum=False)
-                continue
+        # Write to report
+        if not self._running:
+            self.report.write(source_file, dest_file, 'Not started', checksum=False, index=file_id)
+            return
 
-            # Print meta
-            logging.info(f"File modification date: {source_file.mdate}")
-            logging.info(f"Source path: {source_file.path}")
-            logging.info(f"Destination path: {dest_file.path}")
+        # Print meta
+        logging.info(f"File modification date: {source_file.mdate}")
+        logging.info(f"Source path: {source_file.path}")
+        logging.info(f"Destination path: {dest_file.path}")
 
-            # Check for existing files and update filename
+        # Check for existing files and update filename
+        collisions = 0
+        while True:
             while True:
+                # Wait for other workers that are writing to the same path
+                with self._lock:
+                    pending = self._pending_paths.get(self._path_key(dest_file.path))
+                if pending is not None:
+                    pending.wait()
+                    continue
+
                 # Check if destination file exists
-                if dest_file.is_file:
+                if self._destination_index.exists(dest_file.path):
                     # Send signal to GUI
-                    self._signal['action'] = f'Processing file {file_id + 1}/{len(self.source_files.files)} [verifying]'
-                    self._progress_signal.emit(self._signal)
+                    self._emit_progress(f'{progress} [verifying]')
 
                     # Add increment
                     if dest_file.inc < 1:
@@ -209,13 +456,15 @@ class Offloader(QThread):
 
                     # If checksums are matching
                     # if utils.compare_checksums(source_file.checksum, dest_file.checksum):
-                    if utils.compare_files(source_file, dest_file):
+                    if (self._destination_index.size(dest_file.path) == source_file.size
+                            and utils.compare_files(source_file, dest_file)):
                         logging.warning(f"File ({dest_file.filename}) "
                                         f"already exists in destination, skipping")
                         # Write to report
-                        self.report.write(source_file, dest_file, 'Skipped')
+                        self.report.write(source_file, dest_file, 'Skipped', size=source_file.size, index=file_id)
 
-                        self.skipped_files.append(source_file.path)
+                        with self._lock:
+                            self.skipped_files.append(source_file.path)
 
                         skip = True
                         break
@@ -227,107 +476,272 @@ class Offloader(QThread):
                         logging.debug(f'Incremented filename is {dest_file.filename}')
                         continue
                 else:
+                    # Reserve the path so no other worker writes to it
+                    with self._lock:
+                        if self._path_key(dest_file.path) in self._pending_paths:
+                            continue
+                        self._pending_paths[self._path_key(dest_file.path)] = threading.Event()
                     break
 
-            # Perform file actions
-            if not skip:
-                if source_file.path.is_file():
-                    if self._dryrun:
-                        logging.info("DRYRUN ENABLED, NOT PERFORMING FILE ACTIONS")
-                    else:
-                        # Create destination folder
-                        dest_file.path.parent.mkdir(exist_ok=True, parents=True)
-
-                        # Send signal to GUI
-                        self._signal[
-                            'action'] = f'Processing file {file_id + 1}/{len(self.source_files.files)} [copying]'
-                        self._progress_signal.emit(self._signal)
-
-                        # Copy file
-                        utils.pathlib_copy(source_file.path, dest_file.path)
-
-                        # Send signal to GUI
-                        self._signal[
-                            'action'] = f'Processing file {file_id + 1}/{len(self.source_files.files)} [verifying]'
-                        self._progress_signal.emit(self._signal)
-
-                        # Verify file transfer
-                        logging.info("Verifying transferred file")
-
-                        # File transfer successful
-                        if utils.compare_checksums(source_file.checksum, dest_file.checksum):
-                            logging.info("File transferred successfully")
-
-                            # Write to report
-                            self.report.write(source_file, dest_file, 'Successful')
-
-                            # Delete source file
-                            if self._mode == "move":
-                                source_file.delete()
+            if skip:
+                break
 
-                        # File transfer unsuccessful
-                        else:
-                            logging.error("File NOT transferred successfully, mismatching checksums")
-
-                            # Write to report
-                            self.report.write(source_file, dest_file, 'Failed')
-
-                            self.errored_files.append({source_file.path: "Mismatching checksum after transfer"})
+            # Perform file actions
+            try:
+                self._transfer(file_id, source_file, dest_file, progress)
+            except FileExistsError as e:
+                # Only the exclusive create of the file itself is a collision, not a file in place of its folder
+                if e.filename is None or os.fspath(e.filename) != os.fspath(dest_file.path):
+                    raise
+                collisions += 1
+                if collisions > self._max_collisions:
+                    logging.error(f"Gave up on {source_file.filename} after {collisions} taken destinations")
+                    raise
+                # A file that differs only in case or that was created by someone else took the name
+                logging.warning(f"File ({dest_file.filename}) appeared in destination, comparing attributes again")
+                self._destination_index.add(dest_file.path)
+                continue
+            finally:
+                with self._lock:
+                    self._pending_paths.pop(self._path_key(dest_file.path)).set()
+            break
 
+        with self._lock:
             # Add file size to total
             self.ol_bytes_transferred += source_file.size
 
             # Add file to processed files
             self.processed_files.append(source_file.filename)
 
-            # Calculate remaining time
-            logging.info(f"Elapsed time: {utils.time_to_string(self.ol_time_elapsed)}")
+        # Calculate remaining time
+        logging.info(f"Elapsed time: {utils.time_to_string(self.ol_time_elapsed)}")
 
-            # Log transfer speed
-            logging.info(f"Avg. transfer speed: {utils.convert_size(self.ol_speed)}/s")
+        # Log transfer speed
+        logging.info(f"Avg. transfer speed: {utils.convert_size(self.ol_speed)}/s")
 
-            logging.info(f"Size remaining: {utils.convert_size(self.ol_bytes_remaining)}")
-            logging.info(f"Approx. time remaining: {self.ol_time_remaining}")
-            logging.info("---\n")
+        logging.info(f"Size remaining: {utils.convert_size(self.ol_bytes_remaining)}")
+        logging.info(f"Approx. time remaining: {self.ol_time_remaining}")
+        logging.info("---\n")
 
-        # Print created destination folders
-        if self.destination_folders:
-            # Sort folder for better output
-            self.destination_folders.sort()
+    @staticmethod
+    def _path_key(path):
+        """Return the key used to reserve a destination path, without case like the destination filesystems"""
+        return os.fspath(path).casefold()
+
+    def _transfer(self, file_id, source_file, dest_file, progress):
+        """Copy a file to its reserved destination and verify the copy"""
+        # Every file gets a report row, rows after it are held back until it is written
+        if not source_file.path.is_file():
+            logging.warning(f"Source file {source_file.path} is missing, skipping")
+            self.report.write(source_file, dest_file, 'Missing', checksum=False, index=file_id)
+            return
+
+        if self._dryrun:
+            logging.info("DRYRUN ENABLED, NOT PERFORMING FILE ACTIONS")
+            self.report.write(source_file, dest_file, 'Dry run', checksum=False, index=file_id)
+            return
+
+        # Create destination folder
+        dest_file.path.parent.mkdir(exist_ok=True, parents=True)
+
+        # Move files within the same filesystem without copying them
+        if self._mode == 'move' and self._rename(file_id, source_file, dest_file, progress):
+            return
+
+        # Send signal to GUI
+        self._emit_progress(f'{progress} [copying]')
+
+        # Copy file
+        backend = self._select_backend(source_file, dest_file)
+        cloned = False
+        source_checksum = None
+        if backend == 'clone':
+            cloned = utils.clone_file(source_file.path, dest_file.path)
+            if not cloned:
+                # Don't try to clone to this filesystem again
+                logging.debug(f'Cloning not supported for {dest_file.path}, copying instead')
+                with self._lock:
+                    self._no_clone_devices.add(source_file.stat.st_dev)
+                backend = 'kernel'
+        logging.debug(f'Copying using the {backend} backend')
+        if backend == 'kernel':
+            utils.kernel_copy(source_file.path, dest_file.path)
+        elif backend == 'hash':
+            # Hash the source bytes on the way
+            source_checksum = utils.checksum_copy(source_file.path, dest_file.path)
+        self._destination_index.add(dest_file.path, source_file.size)
+        self._sync_policy.file_written(dest_file.path, source_file.size)
+
+        # Send signal to GUI
+        self._emit_progress(f'{progress} [verifying]')
+
+        # Verify file transfer
+        logging.info("Verifying transferred file")
+        if cloned and self._verify != 'disk':
+            # The clone shares its data with the source, so only the size is checked
+            source_checksum = utils.known_checksum(source_file.path, source_file.stat)
+            dest_checksum = source_checksum
+            verified = dest_file.size == source_file.size
+            if verified and source_checksum is not None:
+                utils.store_checksum(dest_file.path, dest_file.stat, source_checksum)
+        else:
+            if source_checksum is None:
+                source_checksum = source_file.checksum
 
-            logging.info(f"Created the following folders {', '.join([str(x.name) for x in self.destination_folders])}")
-            logging.debug([str(x.resolve()) for x in self.destination_folders])
+            uncached = False
+            if self._verify == 'disk':
+                # Make sure the destination is read back from the disk and not from memory. Pages that can't be
+                # dropped are read around instead
+                uncached = not utils.drop_cache(dest_file.path)
 
-        logging.info(f"{len(self.processed_files)} files processed")
-        logging.debug(f"Processed files: {self.processed_files}")
+            dest_checksum = dest_file.update_checksum(uncached=uncached)
+            verified = utils.compare_checksums(source_checksum, dest_checksum)
 
-        logging.info(f"{len(self.destination_folders)} destination folders")
-        logging.debug(f"Destination folders: {self.destination_folders}")
+        # File transfer successful
+        if verified:
+            logging.info("File transferred successfully")
 
-        logging.info(f"{len(self.skipped_files)} files skipped")
-        logging.debug(f"Skipped files: {self.skipped_files}")
+            # Write to report
+            self.report.write(source_file, dest_file, 'Successful',
+                              source_checksum=source_checksum, destination_checksum=dest_checksum,
+                              size=source_file.size, index=file_id)
 
-        # Save report to desktop
-        print(self._running)
-        self.report.save()
-        self.report.write_html()
-        self._signal['time'] = 0
-        self._signal['is_finished'] = True
-        self._progress_signal.emit(self._signal)
+            # Delete the source file at the end of the offload, once the copy is on disk
+            if self._mode == "move":
+                with self._lock:
+                    self._verified_sources.append((source_file.path, source_file.stat, dest_file.path))
+
+        # File transfer unsuccessful
+        else:
+            logging.error("File NOT transferred successfully, mismatching checksums")
+
+            # Write to report
+            self.report.write(source_file, dest_file, 'Failed',
+                              source_checksum=source_checksum, destination_checksum=dest_checksum,
+                              size=source_file.size, index=file_id)
+
+            with self._lock:
+                self.errored_files.append({source_file.path: "Mismatching checksum after transfer"})
+
+            # The copy has the size and modification time of the source, so remove it to keep the next offload
+            # from taking it for a good copy and skipping the file
+            try:
+                dest_file.path.unlink()
+            except OSError as e:
+                logging.error(f"Unable to remove the failed copy {dest_file.path}: {e}")
+            else:
+                self._destination_index.remove(dest_file.path)
+
+    def _delete_sources(self):
+        """Delete the source files in the delete journal"""
+        pending = len(self._delete_journal.pending())
+        if not pending:
+            return
+        logging.info(f"Deleting {pending} verified source files")
+        deleted, skipped = self._delete_journal.delete_all()
+        logging.info(f"{deleted} source files deleted")
+        if skipped:
+            logging.warning(f"{skipped} source files were not deleted")
+
+    def _rename(self, file_id, source_file, dest_file, progress):
+        """Rename a file to its reserved destination if both are on the same device
+
+        Returns:
+            bool: True if the file was moved, False if it has to be copied instead
+
+        Raises:
+            FileExistsError: if another file took the destination, _offload_file then treats it as a collision
+        """
+        source_stat = source_file.stat
+        if source_stat is None or source_stat.st_dev != dest_file.path.parent.stat().st_dev:
+            return False
+
+        # Send signal to GUI
+        self._emit_progress(f'{progress} [moving]')
+
+        checksum = utils.known_checksum(source_file.path, source_stat)
+        if not utils.rename_file(source_file.path, dest_file.path):
+            return False
+        logging.info("File moved by renaming it")
+        self._destination_index.add(dest_file.path, source_file.size)
+        self._sync_policy.file_written(dest_file.path, 0)
+
+        # The data didn't move, so the checksum of the source is valid for the destination
+        if checksum is not None:
+            utils.store_checksum(dest_file.path, dest_file.stat, checksum)
+
+        # Write to report
+        self.report.write(source_file, dest_file, 'Successful',
+                          source_checksum=checksum, destination_checksum=checksum,
+                          size=source_file.size, index=file_id)
         return True
 
+    def _select_backend(self, source_file, dest_file):
+        """Pick how to copy a file
+
+        The auto backend clones files when the source and destination are on the same device and falls back
+        to copying in the kernel if the filesystem doesn't support clones. Files with a known source checksum
+        are also copied in the kernel. Otherwise the source is hashed while it is copied.
+
+        Returns:
+            str: hash, kernel or clone
+        """
+        source_stat = source_file.stat
+        if self._backend == 'clone' and source_stat is not None and source_stat.st_dev in self._no_clone_devices:
+            return 'kernel'
+        if self._backend != 'auto':
+            return self._backend
+
+        if source_stat is None:
+            return 'hash'
+        if source_stat.st_dev == dest_file.path.parent.stat().st_dev:
+            # Clone on copy-on-write filesystems, copy in the kernel on others
+            if source_stat.st_dev in self._no_clone_devices:
+                return 'kernel'
+            return 'clone'
+        if utils.known_checksum(source_file.path, source_stat) is not None:
+            return 'kernel'
+        return 'hash'
+
+    def _emit_progress(self, action):
+        """Send the current progress to the GUI"""
+        with self._lock:
+            self._signal['percentage'] = int(self.ol_percentage)
+            self._signal['action'] = action
+            self._signal['time'] = self.ol_time_remaining
+            self._progress_signal.emit(dict(self._signal))
+
     def run(self):
         logging.info('Hello')
         self.offload()
 
 
 class Report:
-    def __init__(self, report_format='csv'):
+    def __init__(self, report_format='csv', flush_rows=100, flush_interval=5):
+        """Offload report
+
+        Rows are buffered and written to a single open file in batches. Rows with an index are written in the
+        order of their index, no matter in which order the files were transferred.
+
+        Args:
+            report_format: format of the report
+            flush_rows: write buffered rows to disk when this many rows are waiting
+            flush_interval: write buffered rows to disk when this many seconds have passed since the last write
+        """
         self._date = datetime.now()
         self.format = report_format
         self.path = REPORTS_PATH / f"{self._date.strftime('%y%m%d%H%M')}_report.csv"
         self.html_path = self.path.parent / f'{self.path.stem}.html'
         self.html_template_path = APP_DATA_PATH / 'data' / 'report_template.html'
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._rows = []
+        self._ordered_rows = {}
+        self._next_index = 0
+        self._file = None
+        self._writer = None
+        self._last_flush = time.time()
 
         if not self.path.parent.is_dir():
             self.path.parent.mkdir(exist_ok=True, parents=True)
@@ -339,11 +753,44 @@ class Report:
                 writer = csv.writer(report, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
                 writer.writerow(columns)
 
+    def __enter__(self):
+        return self
+
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
         self.write_html()
 
+    def flush(self):
+        """Write buffered rows to the csv file"""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._rows:
+            if self._file is None:
+                self._file = self.path.open('a', newline='')
+                self._writer = csv.writer(self._file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            self._writer.writerows(self._rows)
+            self._rows.clear()
+        if self._file is not None:
+            self._file.flush()
+        self._last_flush = time.time()
+
+    def close(self):
+        """Write buffered rows and close the csv file"""
+        with self._lock:
+            # Rows waiting for a file that was never reported are written in order
+            for index in sorted(self._ordered_rows):
+                self._rows.append(self._ordered_rows.pop(index))
+            self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self._writer = None
+
     def write_html(self):
         """Create html file from csv"""
+        self.flush()
         with self.path.open('r') as report:
             csv_reader = csv.reader(report, delimiter=',')
             line_count = 0
@@ -376,22 +823,60 @@ class Report:
         self.html_path.write_text(html_report)
         return self.html_path
 
-    def write(self, source: File, destination: File, status, checksum=True):
-        with self.path.open('a') as report:
-            writer = csv.writer(report, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            if checksum:
-                columns = [source.filename, destination.filename, status,
-                           source.checksum, destination.checksum,
-                           source.path, destination.path, utils.convert_size(source.size), source.mdate]
+    def write(self, source: File, destination: File, status, checksum=True,
+              source_checksum=None, destination_checksum=None, size=None, index=None):
+        """Add a row to the report
+
+        Args:
+            source: the source file
+            destination: the destination file
+            status: status of the transfer
+            checksum: include checksums in the report
+            source_checksum: checksum of the source if it was computed during the transfer
+            destination_checksum: checksum of the destination if it was computed during the transfer
+            size: size of the file in bytes if it is already known
+            index: position of the row in the report, rows are written as soon as all rows before it are written
+        """
+        if checksum:
+            # Only use checksums that are already known, never read the files again
+            if source_checksum is None:
+                source_checksum = self._known_checksum(source)
+            if destination_checksum is None:
+                destination_checksum = self._known_checksum(destination)
+        else:
+            source_checksum = None
+            destination_checksum = None
+
+        if size is None:
+            size = source.size
+
+        row = [source.filename, destination.filename, status,
+               source_checksum, destination_checksum,
+               source.path, destination.path, utils.convert_size(size), source.mdate]
+
+        with self._lock:
+            if index is None:
+                self._rows.append(row)
             else:
-                columns = [source.filename, destination.filename, status,
-                           None, None,
-                           source.path, destination.path, utils.convert_size(source.size), source.mdate]
-            writer.writerow(columns)
+                self._ordered_rows[index] = row
+                while self._next_index in self._ordered_rows:
+                    self._rows.append(self._ordered_rows.pop(self._next_index))
+                    self._next_index += 1
+            if len(self._rows) >= self.flush_rows or time.time() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    @staticmethod
+    def _known_checksum(file: File):
+        """Return the checksum of a file if it has already been computed"""
+        stat = file.stat
+        if stat is None:
+            return None
+        return utils.known_checksum(file.path, stat)
 
     def save(self, path=None):
         if path is None:
             path = Path().home() / 'Desktop' / f"Offload_Report_{self._date.strftime('%Y-%m-%d_%H%M')}.csv"
+        self.flush()
         utils.pathlib_copy(self.path, path)
 
 
@@ -435,6 +920,113 @@ def cli():
                         help="Move files instead of copy",
                         action="store_true")
 
+    parser.add_argument("-w", "--workers",
+                        type=int,
+                        default=1,
+                        help="Number of files to transfer at the same time.\nDefault: 1",
+                        action="store")
+
+    parser.add_argument("-b", "--backend",
+                        choices=["auto", "hash", "kernel", "clone"],
+                        default="auto",
+                        help="Set how files are copied. \"hash\" hashes the source while copying, \"kernel\" copies "
+                             "inside the kernel and hashes separately, \"clone\" creates copy-on-write clones on "
+                             "the same filesystem, \"auto\" picks one per file.\nDefault: auto",
+                        action="store")
+
+    parser.add_argument("--verify",
+                        choices=["cache", "disk"],
+                        default="cache",
+                        help="Set how copies are verified. \"disk\" flushes each copy and drops it from the page "
+                             "cache before reading it back, or reads around the cache on macOS.\nDefault: cache",
+                        action="store")
+
+    parser.add_argument("--prefetch",
+                        type=int,
+                        default=2,
+                        help="Number of upcoming files to start reading while the current file is transferred. "
+                             "0 disables prefetching.\nDefault: 2",
+                        action="store")
+
+    parser.add_argument("--sync",
+                        default="end",
+                        help="Set when transferred files are flushed to disk: \"none\", \"file\" for every file, "
+                             "\"files:N\" every N files, \"bytes:N\" every N bytes or \"end\" once when "
+                             "finished.\nDefault: end",
+                        action="store")
+
+    parser.add_argument("--read-order",
+                        dest="read_order",
+                        choices=["mtime", "physical"],
+                        default="mtime",
+                        help="Set the order files are read in. \"physical\" follows where the files are stored on "
+                             "the source to avoid seeks on hard drives and fragmented cards. The report is always "
+                             "ordered by modification date.\nDefault: mtime",
+                        action="store")
+
+    parser.add_argument("--scan-workers",
+                        dest="scan_workers",
+                        type=int,
+                        default=1,
+                        help="Number of folders to list at the same time while scanning the source. Speeds up "
+                             "scanning network shares.\nDefault: 1",
+                        action="store")
+
+    parser.add_argument("--ext",
+                        dest="extensions",
+                        action="append",
+                        default=[],
+                        help="Only offload files with these extensions, separated by commas. Can be given several "
+                             "times")
+
+    parser.add_argument("--min-size",
+                        dest="min_size",
+                        type=utils.parse_size,
+                        help="Only offload files of at least this size, e.g. 500KB or 1.5GiB",
+                        action="store")
+
+    parser.add_argument("--max-size",
+                        dest="max_size",
+                        type=utils.parse_size,
+                        help="Only offload files of at most this size, e.g. 500KB or 1.5GiB",
+                        action="store")
+
+    parser.add_argument("--after",
+                        type=datetime.fromisoformat,
+                        help="Only offload files modified at or after this date, e.g. 2026-10-17 or "
+                             "2026-10-17T14:30",
+                        action="store")
+
+    parser.add_argument("--before",
+                        type=datetime.fromisoformat,
+                        help="Only offload files modified before this date, e.g. 2026-10-18",
+                        action="store")
+
+    parser.add_argument("--path",
+                        dest="paths",
+                        action="append",
+                        default=[],
+                        help="Only offload files whose path in the source matches this glob pattern, e.g. "
+                             "\"DCIM/100*/*\". Can be given several times")
+
+    parser.add_argument("--compact",
+                        help="Keep the list of source files in a compact table. Uses far less memory for sources "
+                             "with millions of files",
+                        action="store_true")
+
+    parser.add_argument("--stream",
+                        help="Start transferring files while the source is still being scanned. Files are "
+                             "transferred in the order they are found",
+                        action="store_true")
+
+    parser.add_argument("-x", "--exclude",
+                        action="append",
+                        default=[],
+                        help="Leave out files and folders matching a name, a glob pattern like \"*.tmp\" or a "
+                             "regular expression prefixed with \"re:\". End the rule with \"/\" to only match "
+                             "folders. Can be given several times. Rules are also read from an .offloadignore file "
+                             "in the source folder")
+
     parser.add_argument("--dryrun",
                         help="Run the script without actually changing any files",
                         action="store_true")
@@ -532,6 +1124,19 @@ def cli():
     else:
         mode = "copy"
 
+    # Only offload part of the source
+    extensions = [e.strip() for value in args.extensions for e in value.split(',') if e.strip()]
+    if (extensions or args.paths or args.after or args.before
+            or args.min_size is not None or args.max_size is not None):
+        scan_filter = utils.ScanFilter(extensions=extensions,
+                                       min_size=args.min_size,
+                                       max_size=args.max_size,
+                                       modified_after=args.after,
+                                       modified_before=args.before,
+                                       paths=args.paths)
+    else:
+        scan_filter = None
+
     # Set the log level
     if args.log_level:
         log_level = "debug"
@@ -550,6 +1155,29 @@ def cli():
         if args.name:
             print(f"Name: {args.name}")
         print(f"Prefix: {args.prefix}")
+        print(f"Workers: {args.workers}")
+        print(f"Backend: {args.backend}")
+        print(f"Verify: {args.verify}")
+        print(f"Prefetch: {args.prefetch}")
+        print(f"Sync: {args.sync}")
+        print(f"Read order: {args.read_order}")
+        print(f"Stream: {args.stream}")
+        print(f"Scan workers: {args.scan_workers}")
+        print(f"Compact: {args.compact}")
+        if args.exclude:
+            print(f"Exclude: {', '.join(args.exclude)}")
+        if extensions:
+            print(f"Extensions: {', '.join(extensions)}")
+        if args.min_size is not None:
+            print(f"Min size: {utils.convert_size(args.min_size)}")
+        if args.max_size is not None:
+            print(f"Max size: {utils.convert_size(args.max_size)}")
+        if args.after:
+            print(f"Modified after: {args.after}")
+        if args.before:
+            print(f"Modified before: {args.before}")
+        if args.paths:
+            print(f"Paths: {', '.join(args.paths)}")
         print(f"Log level: {log_level}")
         if args.dryrun:
             print("")
@@ -568,7 +1196,18 @@ def cli():
                    prefix=args.prefix,
                    mode=mode,
                    dryrun=args.dryrun,
-                   log_level=log_level
+                   log_level=log_level,
+                   workers=args.workers,
+                   backend=args.backend,
+                   verify=args.verify,
+                   prefetch=args.prefetch,
+                   sync=args.sync,
+                   read_order=args.read_order,
+                   stream=args.stream,
+                   scan_workers=args.scan_workers,
+                   exclude=args.exclude,
+                   compact=args.compact,
+                   scan_filter=scan_filter
                    )
     ol.offload()
 
@@ -461,6 +461,7 @@ class MainWindow(QMainWindow):
             self.finished()
         elif progress['is_finished'] and not self.offloader._running:
             self.canceled()
+        self.updateSourceInfo()
         self.updateDestInfo()
 
     def canceled(self):
@@ -510,7 +511,8 @@ class MainWindow(QMainWindow):
                                    prefix=self.settings.prefix,
                                    mode='copy',
                                    dryrun=False,
-                                   log_level='debug')
+                                   log_level='debug',
+                                   stream=True)
         self.offloader._progress_signal.connect(self.updateProgressBar)
         self.timer = Timer()
         self.timer._time_signal.connect(self.updateTime)
@@ -518,7 +520,12 @@ class MainWindow(QMainWindow):
         self.updateDestInfo()
 
     def updateSourceInfo(self):
-        self.sourceInfoLabel.setText(f'{self.offloader.source_files.count} files, {self.offloader.source_files.hsize}')
+        source_files = self.offloader.source_files
+        if self.offloader._stream and not source_files.count:
+            # The source is scanned while the files are transferred, so the totals grow during the offload
+            self.sourceInfoLabel.setText('Counted during offload')
+            return
+        self.sourceInfoLabel.setText(f'{source_files.count} files, {source_files.hsize}')
 
     def updateDestInfo(self):
         try: